@@ -1,7 +1,8 @@
 import re
-from typing import List, Set, Tuple
+from typing import List, Set, Tuple, Union
 
 import nltk
+import numpy as np
 
 try:
     from nltk.corpus import wordnet31 as wordnet
@@ -11,22 +12,18 @@ except ImportError:
 
 from keppel.config import Config
 
+# a whitespace run after `{`, `[` or `,`, or before `}` or `]`, collapses to a single space
+_RE_COMPACT_WS = re.compile(r"(?<=[{\[,])\s+|\s+(?=[}\]])")
+
 
 def compact_json(s):
     # % See appendix for example
-    # Remove leading and tRailing whitespace within JSON objects
-    s = re.sub(r"{\s+", "{ ", s)
-    s = re.sub(r"\s+}", " }", s)
-
-    # Remove whitespace after commas within JSON arrays
-    s = re.sub(r",\s+", ", ", s)
+    # Remove whitespace inside JSON objects/arrays and after commas, in a single pass
+    s = _RE_COMPACT_WS.sub(" ", s)
 
-    # Remove leading and trailing whitespace within JSON arrays
-    s = re.sub(r"\[\s+", "[ ", s)
-    s = re.sub(r"\s+\]", " ]", s)
-
-    s = re.sub(r' ("body_font")', r"\n    \1", s)
-    s = re.sub(r"( },) ({)", r"\1\n  \2", s)
+    # literal anchors -- plain `str.replace`, no regex needed
+    s = s.replace(' "body_font"', '\n    "body_font"')
+    s = s.replace(" }, {", " },\n  {")
     return s
 
 
@@ -50,7 +47,18 @@ hyphen_corpus = set(filter(lambda w: "-" in w, wordnet.words()))
 hyphen_corpus = hyphen_corpus.union(hyphen_extras)
 
 
-round_to_nearest_k: callable = lambda number, k: round(number * k) / k
+def round_to_nearest_k(
+    number: Union[float, np.ndarray],
+    k: float,
+    *,
+    _round=round,
+    _isinstance=isinstance,
+) -> Union[float, np.ndarray]:
+    # e.x. k=4 rounds to the nearest 0.25; arrays are rounded element-wise in one go
+    # (`_round`/`_isinstance` are pre-bound builtins; `np` is still a global lookup)
+    if _isinstance(number, np.ndarray):
+        return np.round(number * k) / k  # half-to-even, same as `round`
+    return _round(number * k) / k
 
 
 def clean_fontstr(font: str):
@@ -206,6 +214,10 @@ if __name__ == "__main__":
     assert (res:=process_text((txt:="(figure\n9. SAE)"))) == "", res
     assert (res:=process_text((txt:="pre (fig. 1)."))) == "pre.", res
     # assert (res:=process_text((txt:="Slice Thickness and Pitch (Table Excursion)"))) == txt, res
+
+    assert (res:=compact_json('{\n  "a": [\n 1,\n 2\n ]\n}')) == '{ "a": [ 1, 2 ] }', res
+    assert (res:=compact_json('{\n  "header": "h",\n  "body_font": [ "x" ]\n}')) == '{ "header": "h",\n    "body_font": [ "x" ] }', res
+    assert (res:=compact_json('[\n  {\n    "a": 1\n  },\n  {\n    "b": 2\n  }\n]')) == '[ { "a": 1 },\n  { "b": 2 } ]', res
     # fmt: on
 
     print("All tests passed.")
@@ -220,3 +232,4 @@ if __name__ == "__main__":
 
     assert round_to_nearest_k(1.3, 4) == 1.25
     assert round_to_nearest_k(1.2, 4) == 1.25
+    assert (round_to_nearest_k(np.array([1.2, 1.3, 1.125]), 4) == [1.25, 1.25, 1.0]).all()
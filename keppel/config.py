@@ -1,25 +1,49 @@
+from bisect import bisect_right
+from copy import deepcopy
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import Tuple
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
 
-def extract_chapters(fname: Path) -> List[int]:
+
+def extract_chapters(fname: Path) -> Tuple[int, ...]:
     # TODO implement this
     # - this works only iff the PDF has indexs (embedded Table of Contents)
     # - this lacks the final page of end of final chapter
-    import fitz
+    fname = Path(fname).resolve()
+    stat = fname.stat()
+    return _extract_chapters(fname, stat.st_mtime_ns, stat.st_size)  # immutable, safe to share
 
-    pdf = fitz.open(fname)
 
-    chapters = []
-    for lvl, title, pg in pdf.get_toc():
-        if lvl != 1:
-            continue
+@lru_cache(maxsize=256)
+def _extract_chapters(fname: Path, mtime_ns: int, size: int) -> Tuple[int, ...]:
+    # `mtime_ns`/`size` only key the cache, so a PDF that changes on disk is read again
+    # PyMuPDF is imported here, not at module level: every keppel module imports this one
+    import fitz
+
+    with fitz.open(fname) as pdf:
         # if re.search(r"chapter \d+", title, flags=re.IGNORECASE):
-        # print(f"{title}\tPage: {pg}")
-        chapters.append(pg - 1)  # 0-indexed
-    return chapters
+        return tuple(pg - 1 for lvl, _title, pg in pdf.get_toc() if lvl == 1)  # 0-indexed
+
+
+def load_yaml(cfg_file: Path) -> dict:
+    cfg_file = Path(cfg_file).resolve()
+    stat = cfg_file.stat()
+    # each caller gets its own copy, so mutating one `Config` can't leak into the next
+    return deepcopy(_load_yaml(cfg_file, stat.st_mtime_ns, stat.st_size))
+
+
+@lru_cache(maxsize=16)
+def _load_yaml(cfg_file: Path, mtime_ns: int, size: int) -> dict:
+    # `mtime_ns`/`size` only key the cache, so an edited config file is parsed again
+    with open(cfg_file, "r") as yaml_file:
+        return yaml.load(yaml_file, Loader=SafeLoader)
 
 
 class Config:
@@ -28,9 +52,7 @@ class Config:
             cfg_file = Path(__file__).parent / "config.yaml"
         self.cfg_file = Path(cfg_file)
         assert cfg_file.is_file(), f"Config file {cfg_file} not found"
-        with open(cfg_file, "r") as yaml_file:
-            data = yaml.load(yaml_file, Loader=yaml.FullLoader)
-        self.data = data
+        self.data = load_yaml(self.cfg_file)
 
 
 class BookConfig(Config):
@@ -49,11 +71,9 @@ class BookConfig(Config):
         return list(zip(self.chapters, self.chapters[1:]))
 
     def contained_chapter(self, pg_num):
-        chapter_range = self.chapter_range()
-        for i, (start, end) in enumerate(chapter_range):
-            if (start or float("-inf")) <= pg_num < (end or float("inf")):
-                return i
-        return None
+        # chapters are sorted start pages; chapter i spans [chapters[i], chapters[i + 1])
+        i = bisect_right(self.chapters, pg_num) - 1
+        return i if 0 <= i < len(self.chapters) - 1 else None
 
 
 if __name__ == "__main__":
@@ -1,39 +1,57 @@
+from __future__ import annotations
+
 import json
-import re
 import sys
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Dict, List, Set, Tuple
+from typing import List, Tuple
 
 import fire
 import layoutparser as lp
-import matplotlib.pyplot as plt
+import numpy as np
 import pdfplumber
-from layoutparser.elements import Interval, Layout, TextBlock
+import torch
+from layoutparser.elements import Layout, TextBlock
 from pdfplumber.display import PageImage
 from pdfplumber.page import Page
 from PIL import Image
 from tqdm import tqdm
 
-from keppel.cleaning import clean_fonts, clean_fontstr, compact_json, round_to_nearest_k
+from keppel.cleaning import clean_fontstr, compact_json, round_to_nearest_k
 from keppel.config import BookConfig
 from keppel.tracker import ChapterTracker
 
 DATA = Path("scrape")
 assert DATA.is_dir()
 
-from collections import Counter
-
-
-def extract_fonts(pg: Page, k=4) -> List[Tuple[str, float]]:
-    count = Counter()
-    for ch in pg.chars:
-        # out.add((ch['fontname'], ch['size']))
-        name, size = ch["fontname"], ch["size"]
-        size = round_to_nearest_k(size, k=k) if round else size
-        count[(name, size)] += 1
-
-    out = [(clean_fontstr(fname), fsize) for (fname, fsize), _cnt in count.most_common()]
+TEXT_MODES = frozenset({"Text", "Title"})
+FIGURE_MODES = frozenset({"Figure", "Table"})
+
+
+def extract_fonts(pg: Page, k=4, chars: List[dict] = None) -> List[Tuple[str, float]]:
+    # (fontname, size) pairs ordered by char count, most common first
+    # `chars` lets callers reuse an already-resolved `pg.chars`
+    chars = pg.chars if chars is None else chars
+    if not chars:
+        return []
+    names = np.array([ch["fontname"] for ch in chars], dtype=object)
+    sizes = np.fromiter((ch["size"] for ch in chars), dtype=np.float64, count=len(chars))
+
+    names, name_idx = np.unique(names, return_inverse=True)
+    sizes, size_idx = np.unique(sizes, return_inverse=True)
+    if k:
+        # round the few distinct sizes, not every char; merge what collides
+        sizes, merged = np.unique(round_to_nearest_k(sizes, k), return_inverse=True)
+        size_idx = merged[size_idx]
+    n_sizes = len(sizes)
+    keys, first, counts = np.unique(
+        name_idx * n_sizes + size_idx, return_index=True, return_counts=True
+    )
+    # count descending; ties keep first-seen order, like Counter.most_common
+    keys = keys[np.lexsort((first, -counts))]
+
+    out = [(clean_fontstr(names[key // n_sizes]), float(sizes[key % n_sizes])) for key in keys]
 
     # remove duplicates, but maintain ordering
     dedup = []
@@ -45,7 +63,23 @@ def extract_fonts(pg: Page, k=4) -> List[Tuple[str, float]]:
     return dedup
 
 
+def page_bboxes(labels: List[TextBlock], pad_x, pad_y, w_ratio, h_ratio) -> np.ndarray:
+    # pad every label (image coords) and scale to page coords in one go
+    # same as `label.pad(...)` (safe_mode clips x0/y0 at 0) followed by the per-axis ratio
+    if not labels:
+        return np.empty((0, 4))
+    raw = np.asarray([b.coordinates for b in labels], dtype=np.float64)
+    raw += (-pad_x, -pad_y, pad_x, pad_y)
+    np.maximum(raw[:, :2], 0, out=raw[:, :2])
+    raw *= (w_ratio, h_ratio, w_ratio, h_ratio)
+    return raw
+
+
 class Parser(object):
+    # pages per layout-model forward pass. Not a CLI option yet: the batched path (`_detect`)
+    # stays at 1 until its `__main__` check has passed against detectron2@ff53992b
+    batch_size = 1
+
     def __init__(
         self,
         fname: str,
@@ -55,14 +89,18 @@ class Parser(object):
         resolution=123,
         laparams=dict(detect_vertical=False),
         # laparams=dict(detect_vertical=False, word_margin=0.08)    # this doesn't cause any difference?
+        workers=1,  # >1 spreads each chapter's pages over a process pool
+        run=True,
         **kwargs,
     ) -> None:
         assert 0 <= pad < 1
+        assert workers >= 1
 
         self.fname = Path(fname)
         self.pad = pad
         self.resolution = resolution
         self.laparams = laparams
+        self.workers = workers
 
         self.pdf = pdfplumber.open(fname, laparams=laparams).pages
 
@@ -72,18 +110,27 @@ class Parser(object):
 
         self.cfg: BookConfig = BookConfig(fname)
 
-        self.model = lp.models.Detectron2LayoutModel(
-            # 'lp://PubLayNet/faster_rcnn_R_50_FPN_3x/config',
-            "lp://PubLayNet/mask_rcnn_X_101_32x8d_FPN_3x/config",
-            # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.9],
-            # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.77],
-            # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.72],
-            extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.7],
-            # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.65],
-            label_map={0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"},
-        )
-
-        self.begin(**kwargs)
+        self._model = None
+
+        if run:
+            self.begin(**kwargs)
+
+    def _get_model(self) -> lp.models.Detectron2LayoutModel:
+        # loaded on first use -- with `workers > 1` only the pool processes need one.
+        # A method, not a property: fire's help output reads every attribute of the
+        # returned Parser, which would load the weights in the parent after the run
+        if self._model is None:
+            self._model = lp.models.Detectron2LayoutModel(
+                # 'lp://PubLayNet/faster_rcnn_R_50_FPN_3x/config',
+                "lp://PubLayNet/mask_rcnn_X_101_32x8d_FPN_3x/config",
+                # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.9],
+                # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.77],
+                # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.72],
+                extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.7],
+                # extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", 0.65],
+                label_map={0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"},
+            )
+        return self._model
 
     # @property (??? idk what property actually does)
     def _get_labels(self, im, return_split_idx=False, pad=0.05) -> Layout:
@@ -92,12 +139,40 @@ class Parser(object):
         if type(im) is PageImage:
             im = im.annotated
 
+        layout = self._get_model().detect(im)  # Detect the layout of the input image
+        return self._sort_labels(layout, im, return_split_idx=return_split_idx, pad=pad)
+
+    def _detect(self, ims: List[Image.Image]) -> List[Layout]:
+        # `Detectron2LayoutModel.detect` takes one image; mirror it (and detectron2's
+        # `DefaultPredictor`) to run the whole batch through the network in one call.
+        # Written against layoutparser 0.3.4 (`detect`/`image_loader`/`gather_output`) and
+        # `DefaultPredictor.__call__` at the detectron2 commit pinned in requirements.txt
+        # (ff53992b) -- recheck on upgrade; the `__main__` demo compares it to `detect`
+        if len(ims) == 1:
+            return [self._get_model().detect(ims[0])]
+        model = self._get_model()
+        predictor = model.model
+        inputs = []
+        for im in ims:
+            # PIL hands numpy a fresh `tobytes()` copy either way; `asarray` avoids the second
+            # copy `np.array` (in `image_loader`) makes. The result and the channel-flip view
+            # are read-only -- nothing below writes through them
+            im = np.asarray(im if im.mode == "RGB" else im.convert("RGB"))
+            if predictor.input_format == "RGB":
+                im = im[:, :, ::-1]
+            h, w = im.shape[:2]
+            im = predictor.aug.get_transform(im).apply_image(im)
+            im = torch.as_tensor(im.astype("float32").transpose(2, 0, 1))
+            inputs.append({"image": im, "height": h, "width": w})
+        with torch.no_grad():
+            outputs = predictor.model(inputs)
+        return [model.gather_output(out) for out in outputs]
+
+    def _sort_labels(self, layout: Layout, im, return_split_idx=False, pad=0.05) -> Layout:
         w, h = im.size
 
-        layout = self.model.detect(im)  # Detect the layout of the input image
-
-        text_blocks: Layout = lp.Layout([b for b in layout if b.type in ("Text", "Title")])
-        nontext_blocks: Layout = lp.Layout([b for b in layout if b.type in ("Figure", "Table")])
+        text_blocks: Layout = lp.Layout([b for b in layout if b.type in TEXT_MODES])
+        nontext_blocks: Layout = lp.Layout([b for b in layout if b.type in FIGURE_MODES])
 
         # As there could be text region detected inside the figure region, we just drop them:
         text_blocks: Layout = lp.Layout(
@@ -108,19 +183,15 @@ class Parser(object):
             ]
         )
 
-        # canvas_height=h, canvas_width=w
+        # left column: box center within [0, left_width]; each column then sorted top-to-bottom
         left_width = w / 2 * (1.0 + pad)
-        left_interval: Interval = lp.Interval(0, left_width, axis="x").put_on_canvas(im)
-        left_blocks = text_blocks.filter_by(left_interval, center=True)
-
-        # conjugates
-        right_blocks = [b for b in text_blocks if b not in left_blocks]
+        coords = np.asarray([b.coordinates for b in text_blocks], dtype=np.float64).reshape(-1, 4)
+        center_x = (coords[:, 0] + coords[:, 2]) / 2
+        is_right = ~((0 <= center_x) & (center_x <= left_width))
+        order = np.lexsort((coords[:, 1], is_right))  # stable, same ties as `sorted`
+        n_left = len(order) - int(np.count_nonzero(is_right))
 
-        sort_key = lambda b: b.coordinates[1]
-        left_blocks = sorted(left_blocks, key=sort_key)
-        right_blocks = sorted(right_blocks, key=sort_key)
-
-        text_blocks = [b.set(id=idx) for idx, b in enumerate(left_blocks + right_blocks)]
+        text_blocks = [text_blocks[i].set(id=idx) for idx, i in enumerate(order.tolist())]
 
         for i, b in enumerate(text_blocks):
             for c in text_blocks[:i] + text_blocks[i + 1 :]:  # get all but b
@@ -131,79 +202,134 @@ class Parser(object):
                     print(f"%%% Text block {b.id} is inside {b.parent} -- skipping")
 
         if return_split_idx:
-            return text_blocks, len(left_blocks)
+            return text_blocks, n_left
         else:
             return text_blocks
 
+    def process_pages(self, pgs: List[Page]) -> List[List[tuple]]:
+        # per page: `ChapterTracker.add_txt` arguments for every label, in label order
+        ims = [pg.to_image(resolution=self.resolution).annotated for pg in pgs]
+        layouts = self._detect(ims)
+        return [
+            self._extract_page(pg, im, self._sort_labels(layout, im))
+            for pg, im, layout in zip(pgs, ims, layouts)
+        ]
+
+    def _extract_page(self, pg: Page, im: Image.Image, labels: Layout) -> List[tuple]:
+        out = []
+        pg_num = pg.page_number
+        w_im, h_im = im.size
+        w_pg, h_pg = pg.width, pg.height
+        w_ratio, h_ratio = w_pg / w_im, h_pg / h_im
+
+        pad_x, pad_y = self.pad * w_im, self.pad * h_im
+        bboxes = page_bboxes(labels, pad_x, pad_y, w_ratio, h_ratio).tolist()
+        for label_num, (label, bbox) in enumerate(zip(labels, bboxes)):
+            # print(label)
+            label: TextBlock
+            if label.parent is not None:
+                print(f"%%% Text block {label.id} is inside {label.parent} -- skipping")
+                continue
+            x0, y0, x1, y1 = bbox
+
+            kind = label.type
+            # assert kind in ("Text", "Title")
+
+            area = pg.within_bbox((x0, y0, x1, y1))
+            chars = area.chars  # resolve the crop once for both fonts and text
+            if not chars:
+                continue  # no text -- `add_txt` would drop it anyway
+            fonts = extract_fonts(area, chars=chars)
+            txt = area.extract_text()
+            out.append((txt, kind, fonts, pg_num, label_num))
+        return out
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # pdfplumber pages and the model can't be pickled, so each worker opens its own
+        return ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(
+                self.fname,
+                dict(pad=self.pad, resolution=self.resolution, laparams=self.laparams),
+            ),
+        )
+
     def begin(self):
         chapters = self.cfg.chapter_range()
-        for i, ch in enumerate(chapters, 1):
-            print(f"Processing ch{i}")
-            start, end = ch
-            pages = self.pdf[start:end]  # todo make fctn
-            tracker = ChapterTracker()
-
-            progress = tqdm(pages)
-            for pg in progress:
-                pg_num = pg.page_number
-                im = pg.to_image(resolution=self.resolution).annotated
-                w_im, h_im = im.size
-                w_pg, h_pg = pg.width, pg.height
-                w_ratio, h_ratio = w_pg / w_im, h_pg / h_im
-
-                labels = self._get_labels(im)
-                for label_num, label in enumerate(labels):
-                    # print(label)
-                    label: TextBlock
-                    if label.parent is not None:
-                        print(f"%%% Text block {label.id} is inside {label.parent} -- skipping")
-                        continue
-                    pad_x, pad_y = self.pad * w_im, self.pad * h_im
-                    label = label.pad(left=pad_x, right=pad_x, top=pad_y, bottom=pad_y)
-                    x0, y0, x1, y1 = label.coordinates
-                    x0, x1 = x0 * w_ratio, x1 * w_ratio
-                    y0, y1 = y0 * h_ratio, y1 * h_ratio
-                    # x0,x1 = (x0-pad*w_im)*w_ratio, (x1+pad*w_im)*w_ratio
-                    # y0,y1 = (y0-pad*h_im)*h_ratio, (y1+pad*h_im)*h_ratio
-
-                    kind = label.type
-                    # assert kind in ("Text", "Title")
-
-                    area = pg.within_bbox((x0, y0, x1, y1))
-                    fonts = extract_fonts(area)
-                    txt = area.extract_text()
-                    tracker.add_txt(txt, kind, fonts, pg_num, label_num)
-
-            tracker.close()
-
-            with open(self.outdir / f"ch{i}_tracker.json", "w", encoding="utf8") as f:
-                print(f"*** saving to {f.name}")
-                data = tracker.get_entries()
-                data = [
-                    {k: (list(v) if type(v) is set else v) for k, v in entry.items()}
-                    for entry in data
-                ]  # json-ify: tuples -> lists
-
-                # json.dump(data, f, indent=2, ensure_ascii=False)
-                s = json.dumps(data, indent=2, ensure_ascii=False)
-                s = compact_json(s)
-                f.write(s)
+        with self._pool() if self.workers > 1 else nullcontext() as pool:
+            for i, ch in enumerate(chapters, 1):
+                print(f"Processing ch{i}")
+                start, end = ch
+                pg_idxs = range(len(self.pdf))[start:end]
+                batches = [
+                    pg_idxs[j : j + self.batch_size]
+                    for j in range(0, len(pg_idxs), self.batch_size)
+                ]
+                tracker = ChapterTracker()
+
+                if pool is None:
+                    results = (self.process_pages([self.pdf[idx] for idx in b]) for b in batches)
+                else:
+                    # `map` yields in page order, so the tracker sees the same sequence as serially
+                    results = pool.map(_process_pages, batches)
+                progress = tqdm(total=len(pg_idxs))
+                for batch_txts in results:
+                    for page_txts in batch_txts:
+                        for txt_args in page_txts:
+                            tracker.add_txt(*txt_args)
+                    progress.update(len(batch_txts))
+                progress.close()
+
+                tracker.close()
+
+                with open(self.outdir / f"ch{i}_tracker.json", "w", encoding="utf8") as f:
+                    print(f"*** saving to {f.name}")
+                    data = tracker.get_entries()
+                    data = [
+                        {k: (list(v) if type(v) is set else v) for k, v in entry.items()}
+                        for entry in data
+                    ]  # json-ify: tuples -> lists
+
+                    # json.dump(data, f, indent=2, ensure_ascii=False)
+                    s = json.dumps(data, indent=2, ensure_ascii=False)
+                    s = compact_json(s)
+                    f.write(s)
 
         # figures first: get all figures and associated captions
         # store these figure caption fonts info to use as exclude list later
 
 
+_worker: Parser = None
+
+
+def _init_worker(fname, kwargs):
+    global _worker
+    _worker = Parser(fname, run=False, **kwargs)
+
+
+def _process_pages(pg_idxs: range) -> List[List[tuple]]:
+    return _worker.process_pages([_worker.pdf[idx] for idx in pg_idxs])
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         fire.Fire(Parser)
     else:
         print("No arguments given, running test case")
         fname = Path("scrape/Chest - Webb - Fundamentals of Body CT (4e).pdf")
-        parser = Parser(fname)
+        parser = Parser(fname, run=False)
 
-        pg = parser.pages[0]
+        pg = parser.pdf[0]
 
         # TODO make this function of parser?
         im = pg.to_image(resolution=123).annotated
         sorted_boxes = parser._get_labels(im)
         lp.draw_box(im, sorted_boxes, box_width=3, show_element_id=True)
+
+        # the batched forward pass must match per-image `detect`
+        single = parser._get_model().detect(im)
+        for layout in parser._detect([im, im]):
+            assert len(layout) == len(single), (len(layout), len(single))
+            assert np.allclose([b.coordinates for b in layout], [b.coordinates for b in single])
+        print("Batched detection matches `detect`.")
@@ -25,21 +25,63 @@ TOK_SENTENCE_TERMS = (".", "!", "?")
 TOK_SENTENCE_CONTS = (",", ":", ";")
 TERM_PUNC_STR = "".join(TOK_SENTENCE_TERMS)
 
-TRACKER_MODES = {"startup", "header", "body"}
-LABEL_MODES = {"Title", "Text"}
-
-
-def ends_with(txt, terms=(".", "!", "?", ":")) -> bool:
-    return txt and txt.rstrip().endswith(terms)
+TRACKER_MODES = frozenset({"startup", "header", "body"})
+LABEL_MODES = frozenset({"Title", "Text"})
+
+
+TOK_ENDS_WITH = (".", "!", "?", ":")
+
+
+def _rstrip_end(txt: str, *, _len=len) -> int:
+    # len(txt.rstrip()), without building the stripped copy
+    i = _len(txt)
+    while i and txt[i - 1].isspace():
+        i -= 1
+    return i
+
+
+def ends_with(txt, terms=TOK_ENDS_WITH) -> bool:
+    # `txt.rstrip().endswith(terms)`, without copying txt to strip it
+    return bool(txt) and txt.endswith(terms, 0, _rstrip_end(txt))
+
+
+def overlap_len(body: str, txt: str, *, _len=len, _max=max, _range=range) -> int:
+    # length of the longest suffix of `body` that is also a prefix of `txt` (KMP, linear time)
+    m = _len(txt)
+    if not body or not m:
+        return 0
+    # an overlap is at most len(txt) long and starts with txt[0]: begin the scan at the first
+    # such char in body's tail, and skip the table entirely when there is none
+    start = body.find(txt[0], _max(_len(body) - m, 0))
+    if start < 0:
+        return 0
+    txt = txt[: _len(body) - start]  # nor can it be longer than what's left of body
+    m = _len(txt)
+
+    fail = [0] * m  # fail[i]: longest proper prefix of txt[: i + 1] that is also its suffix
+    k = 0
+    for i in _range(1, m):
+        while k and txt[i] != txt[k]:
+            k = fail[k - 1]
+        if txt[i] == txt[k]:
+            k += 1
+        fail[i] = k
+
+    k = 0
+    for c in body[start:]:
+        if k == m:
+            k = fail[k - 1]
+        while k and c != txt[k]:
+            k = fail[k - 1]
+        if c == txt[k]:
+            k += 1
+    return k
 
 
 def clip_overlap(body, txt):
     # Find the longest common suffix between body and txt
-    overlap = 0
     body, txt = body.rstrip(), txt.lstrip()
-    for i in range(1, min(len(body), len(txt)) + 1):
-        if body[-i:] == txt[:i]:
-            overlap = i
+    overlap = overlap_len(body, txt)
     # rt the non-overlapping part of txt to body
     return txt[overlap:]
 
@@ -249,3 +291,26 @@ class ChapterTracker:
             return
         if log_font_mode:
             self.font_log(fonts, log_font_mode)
+
+
+if __name__ == "__main__":
+    # fmt: off
+    assert (res:=clip_overlap("", "abc")) == "abc", res  # empty body
+    assert (res:=clip_overlap("abc", "")) == "", res  # empty txt
+    assert (res:=clip_overlap("", "")) == "", res
+    assert (res:=clip_overlap("abc", "abc")) == "", res  # full overlap
+    assert (res:=clip_overlap("xyz abc", "abc")) == "", res
+    assert (res:=clip_overlap("bc", "bcdef")) == "def", res  # txt longer than body
+    assert (res:=clip_overlap("c", "cdef")) == "def", res
+    assert (res:=clip_overlap("xaab", "aabz")) == "z", res  # self-overlapping prefixes
+    assert (res:=clip_overlap("aaaa", "aaab")) == "b", res
+    assert (res:=clip_overlap("abab", "ababx")) == "x", res
+    assert (res:=clip_overlap("the end.  \n", "  end. Next")) == " Next", res  # outer whitespace stripped
+    assert (res:=clip_overlap("lorem ipsum", "dolor")) == "dolor", res  # no overlap
+
+    assert (res:=overlap_len("xaab", "aabz")) == 3, res
+    assert (res:=overlap_len("aaaa", "aaab")) == 3, res
+    assert (res:=overlap_len("abc", "")) == 0, res
+    # fmt: on
+
+    print("All tests passed.")